@@ -28,12 +28,24 @@ documented API.  All functions and data are internal to the CLI tool.
 """
 
 import argparse
-import fileinput
+import errno
+import hashlib
+import json
+import mmap
 import os.path
+import re
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
 import jinja2
 import yaml
 
+# use the libyaml based loader if available
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
 # information about the program
 PROG = 'j2render'
 VERSION = '0.0.8'
@@ -67,10 +79,41 @@ without the last extension as file name (e.g., my.txt.j2 -> my.txt).
 
 The options --output and --outdir mutually exclude each other.
 
+Templates can include or extend other templates given by a path relative
+to the current directory, or relative to the directory of any template
+file given on the command line (first match wins).
+
+When rendering three or more different templates with the --outdir
+option, compiled templates are cached in the directory
+"$XDG_CACHE_HOME/{PROG}" (default "~/.cache/{PROG}") to speed up
+subsequent runs.
+
 If several variable files are given (using one --variables option per file),
 their contents are merged into a single data structure.
 '''
 
+# directory for the Jinja2 bytecode cache
+CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    PROG
+)
+# minimum number of different templates to use the bytecode cache
+CACHE_MIN_TEMPLATES = 3
+
+# buffer size for writing output documents
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+# output documents of at least this size bypass the page cache (O_DIRECT)
+DIRECT_IO_THRESHOLD = 2 << 20
+# alignment of buffer address and length required for O_DIRECT
+DIRECT_IO_ALIGNMENT = 4096
+
+# number of template files opened together to read ahead in a batch
+READAHEAD_BATCH = 64
+
+# JSON numbers that the YAML (1.1) loader would resolve to floats
+YAML_FLOAT_RE = re.compile(r'-?[0-9]+\.[0-9]*(?:[eE][-+][0-9]+)?')
+
 # global state variables to control logging output
 debug = None    # pylint: disable=invalid-name
 verbose = None  # pylint: disable=invalid-name
@@ -100,6 +143,10 @@ def vrb(message):
         print(f'{PROG}: info: {message}', file=sys.stderr)
 
 
+def discard(message):  # pylint: disable=unused-argument
+    """Ignore a message of a disabled logging function."""
+
+
 def parse_arguments():
     """Parse command line arguments."""
     arg_prs = argparse.ArgumentParser(
@@ -167,58 +214,295 @@ def parse_arguments():
     return args
 
 
+class TemplateCache(jinja2.FileSystemBytecodeCache):
+    """Store compiled templates in one file per template file."""
+
+    def get_cache_key(self, name, filename=None):
+        """Identify a template by its file and the versions used."""
+        # outdated code is detected by the bucket's source checksum
+        key = [jinja2.__version__, sys.version_info[:]]
+        if filename is not None:
+            key.append(os.path.realpath(filename))
+        else:
+            key.append(name)
+        return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+
+def create_bytecode_cache():
+    """Create a bytecode cache for compiled templates, if possible."""
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+    except OSError as exc:
+        dbg(f'not caching compiled templates: {exc}')
+        return None
+    dbg(f'caching compiled templates in "{CACHE_DIR}"')
+    return TemplateCache(directory=CACHE_DIR, pattern='%s.cache')
+
+
+class TemplateLoader(jinja2.FileSystemLoader):
+    """Load templates by file name, or from the template directories."""
+
+    def get_source(self, environment, template):
+        """Read a template file, or search for it in the search path."""
+        if not os.path.exists(template) or os.path.isdir(template):
+            return super().get_source(environment, template)
+        filename = os.path.abspath(template)
+        mtime = os.path.getmtime(filename)
+        # pylint: disable=invalid-name
+        with open(filename, 'rb') as f:
+            source = f.read().decode('utf-8')
+        return source, filename, lambda: os.path.getmtime(filename) == mtime
+
+
+def create_environment(file_list, use_cache=False):
+    """Create a Jinja2 environment shared by all templates of one run."""
+    search_path = []
+    for template_file in file_list:
+        template_dir = os.path.dirname(template_file) or '.'
+        if template_dir not in search_path:
+            search_path.append(template_dir)
+    dbg(f'template search path = {search_path}')
+    # looking up the cache does not pay off for few templates
+    bytecode_cache = None
+    if (use_cache and len(set(map(os.path.realpath, file_list))) >=
+            CACHE_MIN_TEMPLATES):
+        bytecode_cache = create_bytecode_cache()
+    return jinja2.Environment(
+        loader=TemplateLoader(search_path),
+        cache_size=-1,
+        auto_reload=False,
+        bytecode_cache=bytecode_cache,
+    )
+
+
+def read_chunk_size(size):
+    """Choose the number of bytes per read for a file of the given size."""
+    if size < 1 << 20:
+        return 64 << 10
+    if size < 100 << 20:
+        return 1 << 20
+    return 16 << 20
+
+
+def read_file(fd):
+    """Read all data from a file descriptor."""
+    # pylint: disable=invalid-name
+    size = os.fstat(fd).st_size
+    chunk_size = read_chunk_size(size)
+    data = bytearray(size)
+    length = 0
+    with os.fdopen(fd, 'rb', buffering=0, closefd=False) as f:
+        with memoryview(data) as view:
+            while length < size:
+                count = f.readinto(view[length:length + chunk_size])
+                if not count:
+                    break
+                length += count
+        if length < size:
+            del data[length:]
+        # the file may have grown, or may be a pipe without known size
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            data += chunk
+    return data
+
+
+def read_templates(file_list):
+    """Read template files (or STDIN for "-") in batches."""
+    template_parts = []
+    for start in range(0, len(file_list), READAHEAD_BATCH):
+        batch = file_list[start:start + READAHEAD_BATCH]
+        fds = []
+        try:
+            # open all files of the batch and let the kernel read ahead
+            for template_file in batch:
+                if template_file == '-':
+                    fds.append(None)
+                    continue
+                fds.append(os.open(template_file, os.O_RDONLY))
+                if hasattr(os, 'posix_fadvise'):
+                    try:
+                        os.posix_fadvise(fds[-1], 0, 0,
+                                         os.POSIX_FADV_WILLNEED)
+                    except OSError:
+                        pass  # e.g., a pipe
+            # pylint: disable=invalid-name
+            for template_file, fd in zip(batch, fds):
+                if fd is None:
+                    vrb('reading template from STDIN.')
+                    template_parts.append(sys.stdin.buffer.read())
+                else:
+                    vrb(f'reading template file "{template_file}".')
+                    template_parts.append(read_file(fd))
+        finally:
+            for fd in fds:  # pylint: disable=invalid-name
+                if fd is not None:
+                    os.close(fd)
+    return template_parts
+
+
+def write_direct(data, output):
+    """Write data and a newline to a file bypassing the page cache."""
+    length = len(data) + 1
+    aligned_length = -(-length // DIRECT_IO_ALIGNMENT) * DIRECT_IO_ALIGNMENT
+    try:
+        # pylint: disable=invalid-name
+        fd = os.open(output, os.O_WRONLY | os.O_CREAT | os.O_TRUNC |
+                     os.O_DIRECT, 0o666)
+    except OSError as exc:
+        if exc.errno != errno.EINVAL:
+            raise
+        dbg(f'O_DIRECT not supported for "{output}"')
+        return False
+    try:
+        # anonymous memory maps are page aligned
+        with mmap.mmap(-1, aligned_length) as buf:
+            buf.write(data)
+            buf.write(b'\n')
+            with memoryview(buf) as view:
+                written = 0
+                while written < aligned_length:
+                    written += os.write(fd, view[written:])
+        os.ftruncate(fd, length)
+    except OSError as exc:
+        if exc.errno != errno.EINVAL:
+            raise
+        dbg(f'O_DIRECT write to "{output}" failed')
+        return False
+    finally:
+        os.close(fd)
+    return True
+
+
+def write_document(document, output):
+    """Write a document followed by a newline to a file or STDOUT."""
+    data = document.encode('utf-8')
+    if output is sys.stdout:
+        sys.stdout.buffer.writelines((data, b'\n'))
+        return
+    if (len(data) >= DIRECT_IO_THRESHOLD and hasattr(os, 'O_DIRECT') and
+            write_direct(data, output)):
+        return
+    # pylint: disable=invalid-name
+    with open(output, 'wb', buffering=OUTPUT_BUFFER_SIZE) as f:
+        f.writelines((data, b'\n'))
+
+
 def process_combined(file_list, variables, output):
     """Render one output document by combining all templates."""
     vrb('processing combined template(s).')
-    template_lines = []
-    last_file = ''
-
-    with fileinput.input(file_list) as f:  # pylint: disable=invalid-name
-        for line in f:                     # pylint: disable=invalid-name
-            current_file = f.filename()    # pylint: disable=invalid-name
-            if current_file != last_file:
-                vrb(f'reading template file "{current_file}".')
-                last_file = current_file
-            template_lines.append(line)
-
-    template_string = ''.join(template_lines)
-    template = jinja2.Template(template_string)
+    env = create_environment(file_list)
+    if not file_list:
+        vrb('reading template from STDIN.')
+        template_string = sys.stdin.buffer.read().decode('utf-8')
+    elif len(file_list) == 1 and file_list[0] != '-':
+        # a single template file needs neither batching nor joining
+        vrb(f'reading template file "{file_list[0]}".')
+        fd = os.open(file_list[0], os.O_RDONLY)  # pylint: disable=invalid-name
+        try:
+            template_string = read_file(fd).decode('utf-8')
+        finally:
+            os.close(fd)
+    else:
+        template_parts = read_templates(file_list)
+        template_string = b''.join(template_parts).decode('utf-8')
+    template = env.from_string(template_string)
     vrb('rendering document.')
     document = template.render(**variables)
     if output is sys.stdout:
         vrb('writing output to STDOUT.')
-        print(document)
     else:
         vrb(f'writing output to file "{output}".')
-        # pylint: disable=invalid-name
-        with open(output, 'w') as f:
-            print(document, file=f)
+    write_document(document, output)
     return 0
 
 
+def render_template(template, variables, output):
+    """Render one template and write the document to the output file."""
+    document = template.render(**variables)
+    vrb(f'writing output to "{output}".')
+    write_document(document, output)
+
+
 def process_separate(file_list, variables, outdir):
     """Render one output document per template."""
     vrb('processing separate template files.')
-    for template_file in file_list:
+    env = create_environment(file_list, use_cache=True)
+    outputs = [
+        os.path.join(outdir, os.path.splitext(os.path.basename(tf))[0])
+        for tf in file_list
+    ]
+    if debug is not None:
+        dbg(f'{outputs=}')
+    # only the last template for an output file determines its contents
+    templates = {}
+    for template_file, output in zip(file_list, outputs):
         vrb(f'processing template file "{template_file}".')
-        with open(template_file) as f:  # pylint: disable=invalid-name
-            template_string = f.read()  # pylint: disable=invalid-name
-        template = jinja2.Template(template_string)
-        output_basename = os.path.splitext(os.path.basename(template_file))[0]
-        dbg(f'output_basename = {output_basename}')
-        output = os.path.sep.join([outdir, output_basename])
-        vrb(f'writing output to "{output}".')
-        # pylint: disable=invalid-name
-        with open(output, 'w') as f:
-            print(template.render(**variables), file=f)
+        templates[output] = env.get_template(template_file)
+    workers = min(32, len(templates))
+    dbg(f'rendering with {workers} worker thread(s)')
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(render_template, templates.values(),
+                          repeat(variables), templates.keys()))
     return 0
 
 
+def parse_json_float(text):
+    """Convert a JSON number with fraction or exponent like YAML does."""
+    if YAML_FLOAT_RE.fullmatch(text):
+        return float(text)
+    return text
+
+
+def parse_variables(f):  # pylint: disable=invalid-name
+    """Parse variable definitions given in JSON or YAML format."""
+    # JSON is (almost) a subset of YAML, but can be parsed much faster
+    if f.peek(64)[:64].lstrip()[:1] in (b'{', b'['):
+        data = f.read()
+        try:
+            # keep values YAML would not resolve to floats (e.g., 1e5, NaN)
+            return json.loads(data.decode('utf-8'),
+                              parse_float=parse_json_float,
+                              parse_constant=str)
+        except ValueError:
+            dbg('variables are not valid JSON, parsing them as YAML.')
+        return yaml.load(data, Loader=YamlLoader)
+    return yaml.load(f, Loader=YamlLoader)
+
+
+def load_variables(vars_file, remove_root_key):
+    """Read variables from a YAML file, return None if invalid."""
+    vrb(f'reading variables from file "{vars_file}".')
+    try:
+        # pylint: disable=invalid-name
+        with open(vars_file, 'rb') as f:
+            tmp = parse_variables(f)
+    except yaml.YAMLError as exc:
+        err(f'cannot parse variables file "{vars_file}":\n{exc}')
+        return None
+    if debug is not None:
+        dbg(f'{tmp=}')
+    if tmp is not None and not isinstance(tmp, dict):
+        err('variables must be given as key/value pairs.')
+        return None
+    if remove_root_key and tmp and len(tmp.keys()) == 1:
+        dbg(f'removing root key from vars in file "{vars_file}"')
+        tmp = tmp[next(iter(tmp.keys()))]
+        if debug is not None:
+            dbg(f'{tmp=}')
+    return {} if tmp is None else tmp
+
+
 def main():
     """Entry point for command line tool."""
     global debug    # pylint: disable=global-statement,invalid-name
     global verbose  # pylint: disable=global-statement,invalid-name
     global quiet    # pylint: disable=global-statement,invalid-name
+    global dbg      # pylint: disable=global-statement,invalid-name
+    global vrb      # pylint: disable=global-statement,invalid-name
+    global wrn      # pylint: disable=global-statement,invalid-name
     variables = {}
 
     # parse command line arguments
@@ -233,42 +517,47 @@ def main():
         debug = True
         dbg('enabling debug information.')
     vrb('parsed command line arguments.')
+    # avoid checking the logging state for every disabled message
+    if debug is None:
+        dbg = discard
+    if verbose is None or quiet is not None:
+        vrb = discard
+    if quiet is not None:
+        wrn = discard
 
     # load variables
     vrb('looking for variable definitions.')
     if args.variables:
         if len(args.variables) > 1 and not args.remove_root_key:
             wrn('variables with identical root key overwrite each other.')
-        for vars_file in args.variables:
-            vrb(f'reading variables from file "{vars_file}".')
-            with open(vars_file, 'r') as f:    # pylint: disable=invalid-name
-                tmp = yaml.safe_load(f)        # pylint: disable=invalid-name
-            dbg(f'{tmp=}')
-            if tmp and not isinstance(tmp, dict):
-                err('variables must be given as key/value pairs.')
-                return 1
-            if (args.remove_root_key and tmp and isinstance(tmp, dict) and
-                    len(tmp.keys()) == 1):
-                dbg(f'removing root key from vars in file "{vars_file}"')
-                tmp = tmp[next(iter(tmp.keys()))]
-                dbg(f'{tmp=}')
-            vrb('merging just read variables.')
+        parsed_variables = [
+            load_variables(vars_file, args.remove_root_key)
+            for vars_file in args.variables
+        ]
+        if None in parsed_variables:
+            return 1
+        vrb('merging variables.')
+        for tmp in parsed_variables:
             variables.update(tmp)
+        if debug is not None:
             dbg(f'{variables=}')
 
     # render templates (two general cases: separate or combined output)
-    dbg(f'args.TEMPLATE = {args.TEMPLATE}')
+    if debug is not None:
+        dbg(f'args.TEMPLATE = {args.TEMPLATE}')
     # case of combining all templates to produce one output file
     if args.outdir is None:
-        dbg(f'calling process_combined({args.TEMPLATE}, {variables}, ' +
-            f'{args.output})')
+        if debug is not None:
+            dbg(f'calling process_combined({args.TEMPLATE}, {variables}, ' +
+                f'{args.output})')
         ret = process_combined(args.TEMPLATE, variables, args.output)
     # case of writing one output file per template
     else:
         dbg(f'args.outdir = {args.outdir}')
         outdir = os.path.normpath(args.outdir)
-        dbg(f'calling process_separate({args.TEMPLATE}, {variables}, ' +
-            f'{outdir})')
+        if debug is not None:
+            dbg(f'calling process_separate({args.TEMPLATE}, {variables}, ' +
+                f'{outdir})')
         ret = process_separate(args.TEMPLATE, variables, outdir)
     dbg(f'rendering function returned "{ret}"')
 